@@ -4,7 +4,19 @@ from PIL import Image
 from datetime import datetime
 import io
 import json
-from flask import Flask, render_template_string, request, redirect, url_for, flash
+import sys
+import time
+import hmac
+import uuid
+import threading
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager, nullcontext
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+from flask import Flask, render_template_string, request, redirect, url_for, flash, g, abort, jsonify, Response, has_request_context
 import toml
 
 # === Load API Key from secrets.toml ===
@@ -24,6 +36,165 @@ app.secret_key = 'supersecretkey'  # Needed for flash messages
 UPLOAD_FOLDER = 'images'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# === On-demand Profiling (admin only) ===
+# A request carrying the token from [profiling] in secrets.toml in its
+# X-Profile-Token header is run under a stack sampler and tracemalloc.
+# Requests without it only pay for one header lookup, except while a profile
+# is running: tracemalloc is process-wide, so concurrent requests then pay its
+# allocation overhead and their allocations count towards py_peak_alloc_kb.
+# tracemalloc only sees the Python heap; Pillow's pixel buffers are malloc'd
+# directly, so they are reported separately from Pillow's block stats and
+# the growth of the process RSS high-water mark.
+def load_profiling_token():
+    try:
+        secrets = toml.load('secrets.toml')
+        return secrets.get('profiling', {}).get('token') or None
+    except Exception:
+        return None
+
+PROFILING_TOKEN = load_profiling_token()
+PROFILE_HISTORY = 20
+PROFILE_SAMPLE_INTERVAL = 0.005
+profiles = deque(maxlen=PROFILE_HISTORY)
+profiles_lock = threading.Lock()
+profiler_busy = threading.Lock()  # tracemalloc is process-wide, so one profiled request at a time
+NO_STAGE = nullcontext()
+
+def has_profiling_token(token):
+    if not PROFILING_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode(), PROFILING_TOKEN.encode())
+
+class StackSampler(threading.Thread):
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                module = frame.f_globals.get('__name__', '?')
+                stack.append(f"{module}:{getattr(code, 'co_qualname', code.co_name)}")
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def collapsed(self):
+        # Brendan Gregg's folded format: "root;...;leaf count" per line
+        return '\n'.join(f"{stack} {count}" for stack, count in self.counts.most_common())
+
+def max_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss  # bytes on macOS, KB elsewhere
+
+def stage(name):
+    profile = g.get('profile') if has_request_context() else None
+    if profile is None:
+        return NO_STAGE
+    return timed_stage(profile, name)
+
+@contextmanager
+def timed_stage(profile, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        profile['stages'][name] = profile['stages'].get(name, 0.0) + elapsed
+
+@app.before_request
+def start_profiling():
+    if PROFILING_TOKEN is None or request.endpoint in ('static', 'profiles_index', 'profile_collapsed'):
+        return
+    if not has_profiling_token(request.headers.get('X-Profile-Token')):
+        return
+    if not profiler_busy.acquire(blocking=False):
+        g.profile_skipped = 'busy'
+        return
+    sampler = StackSampler(threading.get_ident())
+    owns_tracemalloc = not tracemalloc.is_tracing()
+    try:
+        if owns_tracemalloc:
+            tracemalloc.start()
+        else:
+            tracemalloc.reset_peak()
+        sampler.start()
+    except Exception:
+        if owns_tracemalloc:
+            tracemalloc.stop()
+        profiler_busy.release()
+        g.profile_skipped = 'error'
+        return
+    g.profile = {
+        'id': uuid.uuid4().hex[:12],
+        'method': request.method,
+        'path': request.path,
+        'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'status': None,
+        'stages': {},
+        'sampler': sampler,
+        'owns_tracemalloc': owns_tracemalloc,
+        'pil_stats': Image.core.get_stats(),
+        'max_rss_kb': max_rss_kb(),
+        'start': time.perf_counter(),
+    }
+
+@app.after_request
+def tag_profiled_response(response):
+    profile = g.get('profile')
+    if profile is not None:
+        profile['status'] = response.status_code
+        response.headers['X-Profile-Id'] = profile['id']
+    elif g.get('profile_skipped'):
+        response.headers['X-Profile-Skipped'] = g.profile_skipped
+    return response
+
+@app.teardown_request
+def finish_profiling(exc):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    try:
+        total = time.perf_counter() - profile['start']
+        sampler = profile['sampler']
+        sampler.stop()
+        _, peak = tracemalloc.get_traced_memory()
+        pil_stats = Image.core.get_stats()
+        rss_kb = max_rss_kb()
+    finally:
+        if profile['owns_tracemalloc']:
+            tracemalloc.stop()
+        profiler_busy.release()
+    record = {
+        'id': profile['id'],
+        'method': profile['method'],
+        'path': profile['path'],
+        'started': profile['started'],
+        'status': profile['status'] if exc is None else 500,
+        'total_ms': round(total * 1000, 2),
+        'stages_ms': {name: round(secs * 1000, 2) for name, secs in profile['stages'].items()},
+        'py_peak_alloc_kb': round(peak / 1024, 1),
+        'pil_images_created': pil_stats['new_count'] - profile['pil_stats']['new_count'],
+        'pil_blocks_allocated': pil_stats['allocated_blocks'] - profile['pil_stats']['allocated_blocks'],
+        'max_rss_growth_kb': None if rss_kb is None else rss_kb - profile['max_rss_kb'],
+        'samples': sum(sampler.counts.values()),
+        'collapsed': sampler.collapsed(),
+    }
+    with profiles_lock:
+        profiles.append(record)
+
 # === HTML Template ===
 TEMPLATE = '''
 <!DOCTYPE html>
@@ -522,19 +693,23 @@ TEMPLATE = '''
 
 def process_image(file_storage, filename):
     try:
-        image_data = file_storage.read()
-        img = Image.open(io.BytesIO(image_data))
-        if img.mode in ("RGBA", "P"):
-            background = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "RGBA":
-                background.paste(img, mask=img.split()[-1])
-            else:
-                background.paste(img)
-            img = background
+        # Image.open is lazy: for RGB uploads the pixel decode is timed under resize/encode
+        with stage('decode'):
+            image_data = file_storage.read()
+            img = Image.open(io.BytesIO(image_data))
+            if img.mode in ("RGBA", "P"):
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                if img.mode == "RGBA":
+                    background.paste(img, mask=img.split()[-1])
+                else:
+                    background.paste(img)
+                img = background
         max_size = 1024
         if img.size[0] > max_size or img.size[1] > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        img.save(filename, format="JPEG", quality=85, optimize=True)
+            with stage('resize'):
+                img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+        with stage('encode'):
+            img.save(filename, format="JPEG", quality=85, optimize=True)
         return open(filename, "rb")
     except Exception as e:
         return None
@@ -583,8 +758,9 @@ def index():
         try:
             # Process all files from image1
             files_to_send = []
+            uploads = request.files.getlist('image1')
             if image1 and image1.filename:
-                for f in image1.files:
+                for f in uploads:
                     file_data = process_image(f, os.path.join(UPLOAD_FOLDER, f.filename))
                     if file_data:
                         files_to_send.append(('images', (f.filename, file_data, f.content_type)))
@@ -596,44 +772,47 @@ def index():
                 return redirect(url_for('index'))
 
             params = {"api-key": API_KEY}
-            response = requests.post(
-                API_URL,
-                files=files_to_send,
-                params=params,
-                timeout=45
-            )
-            for filename in [os.path.join(UPLOAD_FOLDER, f.filename) for f in image1.files]:
+            with stage('upstream'):
+                response = requests.post(
+                    API_URL,
+                    files=files_to_send,
+                    params=params,
+                    timeout=45
+                )
+            for filename in [os.path.join(UPLOAD_FOLDER, f.filename) for f in uploads]:
                 if os.path.exists(filename):
                     os.remove(filename)
             if response.status_code == 200:
-                result = response.json()
-                api_results = result.get("results", [])
+                with stage('parse'):
+                    result = response.json()
+                    api_results = result.get("results", [])
+                    if api_results:
+                        shown_results = min(len(api_results), max_results)
+                        for r in api_results[:max_results]:
+                            species = r.get("species", {})
+                            score = round(r.get("score", 0) * 100, 2)
+                            scientific_name = safe_get(species, "scientificNameWithoutAuthor", "Unknown Species")
+                            common_names = species.get("commonNames", [])
+                            family_info = species.get("family", {})
+                            genus_info = species.get("genus", {})
+                            family_name = safe_get(family_info, "scientificNameWithoutAuthor", "Unknown Family")
+                            genus_name = safe_get(genus_info, "scientificNameWithoutAuthor", "Unknown Genus")
+                            confidence_class = get_confidence_class(score)
+                            common_names_str = ', '.join(common_names[:3]) if common_names else 'Not available'
+                            results.append({
+                                'scientific_name': scientific_name,
+                                'common_names': common_names_str,
+                                'family_name': family_name,
+                                'genus_name': genus_name,
+                                'confidence_class': confidence_class,
+                                'confidence_str': format_confidence(score)
+                            })
+                        total_matches = len(api_results)
+                        best_match = max([r.get("score", 0) * 100 for r in api_results if r.get("score", 0) > 0], default=0)
+                        valid_scores = [r.get("score", 0) * 100 for r in api_results if r.get("score", 0) > 0]
+                        avg_confidence = round(sum(valid_scores) / len(valid_scores), 1) if valid_scores else 0
+                        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 if api_results:
-                    shown_results = min(len(api_results), max_results)
-                    for r in api_results[:max_results]:
-                        species = r.get("species", {})
-                        score = round(r.get("score", 0) * 100, 2)
-                        scientific_name = safe_get(species, "scientificNameWithoutAuthor", "Unknown Species")
-                        common_names = species.get("commonNames", [])
-                        family_info = species.get("family", {})
-                        genus_info = species.get("genus", {})
-                        family_name = safe_get(family_info, "scientificNameWithoutAuthor", "Unknown Family")
-                        genus_name = safe_get(genus_info, "scientificNameWithoutAuthor", "Unknown Genus")
-                        confidence_class = get_confidence_class(score)
-                        common_names_str = ', '.join(common_names[:3]) if common_names else 'Not available'
-                        results.append({
-                            'scientific_name': scientific_name,
-                            'common_names': common_names_str,
-                            'family_name': family_name,
-                            'genus_name': genus_name,
-                            'confidence_class': confidence_class,
-                            'confidence_str': format_confidence(score)
-                        })
-                    total_matches = len(api_results)
-                    best_match = max([r.get("score", 0) * 100 for r in api_results if r.get("score", 0) > 0], default=0)
-                    valid_scores = [r.get("score", 0) * 100 for r in api_results if r.get("score", 0) > 0]
-                    avg_confidence = round(sum(valid_scores) / len(valid_scores), 1) if valid_scores else 0
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                     return redirect(url_for('index', success=1))
                 else:
                     warning = "🤔 No species matches found. This could be due to image quality issues, unusual plant species, or unclear plant parts. Try uploading clearer images or different plant parts."
@@ -659,7 +838,32 @@ def index():
         except Exception as e:
             flash(f'Unexpected error: {str(e)}')
             return redirect(url_for('index', success=0))
-    return render_template_string(TEMPLATE, results=results, shown_results=shown_results, warning=warning, show_details=show_details, total_matches=total_matches, best_match=best_match, avg_confidence=avg_confidence, timestamp=timestamp)
+    with stage('render'):
+        return render_template_string(TEMPLATE, results=results, shown_results=shown_results, warning=warning, show_details=show_details, total_matches=total_matches, best_match=best_match, avg_confidence=avg_confidence, timestamp=timestamp)
+
+# === Profile Viewer (admin only) ===
+def require_profiling_admin():
+    if PROFILING_TOKEN is None:
+        abort(404)
+    if not has_profiling_token(request.headers.get('X-Profile-Token')):
+        abort(403)
+
+@app.route('/admin/profiles')
+def profiles_index():
+    require_profiling_admin()
+    with profiles_lock:
+        recent = list(profiles)
+    return jsonify([{k: v for k, v in p.items() if k != 'collapsed'} for p in reversed(recent)])
+
+@app.route('/admin/profiles/<profile_id>.folded')
+def profile_collapsed(profile_id):
+    require_profiling_admin()
+    with profiles_lock:
+        match = next((p for p in profiles if p['id'] == profile_id), None)
+    if match is None:
+        abort(404)
+    return Response(match['collapsed'] + '\n', mimetype='text/plain')
+
 if __name__ == '__main__':
     app.run(debug=True, port=5002)
     
\ No newline at end of file